@@ -0,0 +1,191 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+bench_dir = Path(__file__).parent
+repo_dir = bench_dir.parent
+
+
+def prepare_environment(root, args):
+    """Point the decky paths at a scratch directory and write the plugin config."""
+    for name in ("settings", "runtime", "logs", "AddOns"):
+        (root / name).mkdir(parents=True, exist_ok=True)
+    os.environ.update({
+        "DECKY_HOME": str(root),
+        "DECKY_USER_HOME": str(root),
+        "DECKY_PLUGIN_SETTINGS_DIR": str(root / "settings"),
+        "DECKY_PLUGIN_RUNTIME_DIR": str(root / "runtime"),
+        "DECKY_PLUGIN_LOG_DIR": str(root / "logs"),
+    })
+    with open(root / "settings" / "config.json", 'w') as f:
+        json.dump({
+            "game_version": 517,
+            "page_size": 3,
+            "check_workers": args.check_workers,
+            "download_workers": args.download_workers,
+            "extract_workers": args.extract_workers,
+            "extract_threads": args.extract_threads,
+            "cache_max_bytes": 4 * 1024 * 1024 * 1024,
+            "target_dir": str(root / "AddOns"),
+            "last_update_check": 0
+        }, f, indent=4)
+    sys.path[:0] = [str(bench_dir), str(repo_dir / "py_modules"), str(repo_dir)]
+
+
+def start_server(args):
+    """Run the stand-in server in its own process so it doesn't skew peak RSS."""
+    command = [sys.executable, str(bench_dir / "fake_curseforge.py"), "--fixtures", args.fixtures,
+               "--latency", str(args.latency), "--error-rate", str(args.error_rate)]
+    if args.bandwidth:
+        command += ["--bandwidth", str(args.bandwidth)]
+    if args.archive_files:
+        command += ["--archive-files", str(args.archive_files)]
+    if args.file_size:
+        command += ["--file-size", str(args.file_size)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    base_url = process.stdout.readline().strip()
+    return process, base_url
+
+
+def server_stats(base_url):
+    stats_url = base_url.split("/api/")[0] + "/_stats"
+    with urllib.request.urlopen(stats_url) as response:
+        return json.load(response)
+
+
+def peak_rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def run_phase(name, action, base_url, commits):
+    before = server_stats(base_url)
+    commits[0] = 0
+    start = time.perf_counter()
+    await action()
+    wall_time = time.perf_counter() - start
+    after = server_stats(base_url)
+    return {
+        "phase": name,
+        "wall_time": wall_time,
+        "requests": after["requests"] - before["requests"],
+        "bytes": after["bytes_sent"] - before["bytes_sent"],
+        "peak_rss_kib": peak_rss_kib(),
+        "sqlite_commits": commits[0],
+    }
+
+
+async def run_benchmark(plugin, fixtures, base_url, target_dir):
+    """Drive a cold check, two repeat checks, upgrade_all and a clean reinstall."""
+    commits = [0]
+    plugin.db.connect().set_trace_callback(
+        lambda statement: commits.__setitem__(0, commits[0] + (statement.strip().upper() == "COMMIT")))
+    plugin.init_plugin()
+    for project in fixtures["projects"]:
+        plugin.add_addon_to_db(project["project_id"], project["name"])
+    rpc = plugin.Plugin()
+
+    async def reinstall():
+        shutil.rmtree(target_dir)
+        target_dir.mkdir()
+        versions = [addon for addon in plugin.load_wanted_addons_from_sqlite() if addon["current_version_id"]]
+        for addon in versions:
+            version = {"project_id": addon["project_id"], "version_id": addon["current_version_id"], "file_name": ""}
+            await asyncio.to_thread(plugin.extract_file, version)
+
+    return [
+        await run_phase("check (cold)", rpc.manual_check_for_updates, base_url, commits),
+        await run_phase("check (warm)", rpc.manual_check_for_updates, base_url, commits),
+        await run_phase("check (unchanged)", rpc.manual_check_for_updates, base_url, commits),
+        await run_phase("upgrade_all", rpc.upgrade_all, base_url, commits),
+        await run_phase("extract_file (clean)", reinstall, base_url, commits),
+    ]
+
+
+def print_results(results):
+    print(f"{'phase':<22}{'wall s':>9}{'requests':>10}{'bytes':>14}{'peak RSS KiB':>14}{'commits':>9}")
+    for result in results:
+        print(f"{result['phase']:<22}{result['wall_time']:>9.3f}{result['requests']:>10}{result['bytes']:>14}"
+              f"{result['peak_rss_kib']:>14}{result['sqlite_commits']:>9}")
+
+
+def print_operations(snapshot):
+    print(f"{'operation':<22}{'calls':>9}{'mean ms':>10}{'max ms':>14}{'bytes':>14}")
+    for name, operation in sorted(snapshot["operations"].items()):
+        print(f"{name:<22}{operation['count']:>9}{operation['mean_ms']:>10.2f}{operation['max_ms']:>14.2f}"
+              f"{operation['bytes']:>14}")
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    """Return the phases whose wall time regressed by more than tolerance."""
+    with open(baseline_path, 'r') as f:
+        baseline = {result["phase"]: result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["phase"])
+        if previous and result["wall_time"] > previous["wall_time"] * (1 + tolerance):
+            regressions.append(f"{result['phase']}: {previous['wall_time']:.3f}s -> {result['wall_time']:.3f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark checks and upgrades against a local CurseForge stand-in.")
+    parser.add_argument("--fixtures", default=str(bench_dir / "fixtures.json"))
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--archive-files", type=int, default=None, help="override files per archive")
+    parser.add_argument("--file-size", type=int, default=None, help="override bytes per archived file")
+    parser.add_argument("--check-workers", type=int, default=8)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--extract-workers", type=int, default=1)
+    parser.add_argument("--extract-threads", type=int, default=4)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed wall time regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    with open(args.fixtures, 'r') as f:
+        fixtures = json.load(f)
+
+    with tempfile.TemporaryDirectory(prefix="wow-addon-bench-") as root:
+        root = Path(root)
+        prepare_environment(root, args)
+        server, base_url = start_server(args)
+        try:
+            import curseforge_client
+            curseforge_client.base_url = base_url
+            plugin = importlib.import_module("main")
+            results = asyncio.run(run_benchmark(plugin, fixtures, base_url, root / "AddOns"))
+            operations = asyncio.run(plugin.Plugin().get_perf_stats())
+            plugin.client.close()
+            plugin.db.close()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print_results(results)
+    print()
+    print_operations(operations)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Minimal stand-in for the `decky` module decky-loader injects at runtime.
+
+Only used by the benchmark, so main.py can be imported outside the loader.
+Paths come from the same environment variables the loader sets.
+"""
+import logging
+import os
+
+DECKY_HOME = os.environ["DECKY_HOME"]
+DECKY_USER_HOME = os.environ.get("DECKY_USER_HOME", DECKY_HOME)
+DECKY_PLUGIN_SETTINGS_DIR = os.environ["DECKY_PLUGIN_SETTINGS_DIR"]
+DECKY_PLUGIN_RUNTIME_DIR = os.environ["DECKY_PLUGIN_RUNTIME_DIR"]
+DECKY_PLUGIN_LOG_DIR = os.environ["DECKY_PLUGIN_LOG_DIR"]
+DECKY_PLUGIN_DIR = os.environ.get("DECKY_PLUGIN_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DECKY_PLUGIN_VERSION = os.environ.get("DECKY_PLUGIN_VERSION", "bench")
+
+logger = logging.getLogger("decky_wow_addon_updater")
+
+events = []
+
+
+async def emit(event, *args):
+    events.append((event, args))
+
+
+def migrate_logs(*files_or_directories):
+    return {}
+
+
+def migrate_settings(*files_or_directories):
+    return {}
+
+
+def migrate_runtime(*files_or_directories):
+    return {}
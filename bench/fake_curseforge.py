@@ -0,0 +1,216 @@
+import argparse
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from hashlib import sha1, sha256
+from urllib.parse import parse_qs, urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+fixtures_path = Path(__file__).parent / "fixtures.json"
+
+files_pattern = re.compile(r"^/api/v1/mods/(\d+)/files(?:\?.*)?$")
+download_pattern = re.compile(r"^/api/v1/mods/(\d+)/files/(\d+)/download$")
+
+
+def load_fixtures(path=fixtures_path):
+    """Load the project fixtures served by the stand-in server."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def build_archive(project, version_id, archive_files, file_size):
+    """Build a zip that looks like an addon release: a toc plus Lua/XML/TGA files."""
+    rng = random.Random(version_id)
+    folder = project["name"].replace(" ", "")
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(f"{folder}/{folder}.toc", f"## Title: {project['name']}\n## Version: {version_id}\n")
+        for index in range(archive_files):
+            extension = ("lua", "xml", "tga")[index % 3]
+            if extension == "tga":
+                # Incompressible payload, like textures.
+                content = rng.randbytes(file_size)
+            else:
+                # Mostly stable source with a version-dependent tail, so releases differ slightly.
+                content = (f"-- {folder} file {index}\n" * (file_size // 24)).encode()
+                if index % 10 == 0:
+                    content += f"-- build {version_id}\n".encode()
+            zip_file.writestr(f"{folder}/Modules/file{index}.{extension}", content)
+    return buffer.getvalue()
+
+
+class FakeCurseForge:
+    """Local stand-in for the CurseForge "/files" and "/download" endpoints.
+
+    Serves listings and zips generated from fixtures with configurable latency,
+    bandwidth and error rate, and counts the requests and bytes it served.
+    """
+
+    def __init__(self, fixtures, latency=0.0, bandwidth=None, error_rate=0.0, archive_files=None, file_size=None,
+                 game_version=517, seed=0):
+        self.projects = {project["project_id"]: project for project in fixtures["projects"]}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.archive_files = archive_files
+        self.file_size = file_size
+        self.game_version = game_version
+        self.random = random.Random(seed)
+        self.archives = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_port}/api/v1/mods/"
+
+    def version_ids(self, project):
+        return [project["project_id"] * 1000 + index for index in range(project.get("versions", 3))]
+
+    def archive(self, project, version_id):
+        key = (project["project_id"], version_id)
+        with self.lock:
+            if key not in self.archives:
+                self.archives[key] = build_archive(project, version_id,
+                                                   self.archive_files or project.get("archive_files", 50),
+                                                   self.file_size or project.get("file_size", 2048))
+            return self.archives[key]
+
+    def listing(self, project, page_index=0, page_size=50):
+        """Render one page of the listing, newest file first."""
+        version_ids = list(reversed(self.version_ids(project)))
+        data = []
+        for version_id in version_ids[page_index * page_size:(page_index + 1) * page_size]:
+            data.append({
+                "id": version_id,
+                "fileName": f"{project['name'].replace(' ', '')}-{version_id}.zip",
+                "dateCreated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1700000000 + version_id % 1000 * 86400)),
+                "isAvailableForDownload": True,
+                "gameVersions": ["11.0.7"],
+                "gameVersionTypeIds": [self.game_version],
+                "fileLength": len(self.archive(project, version_id)),
+                "hashes": [{"value": sha1(self.archive(project, version_id)).hexdigest(), "algo": 1}],
+            })
+        pagination = {"index": page_index, "pageSize": page_size, "totalCount": len(version_ids)}
+        return json.dumps({"data": data, "pagination": pagination}).encode()
+
+    def start(self):
+        # Build every archive up front so generation time never shows up as request latency.
+        for project in self.projects.values():
+            for version_id in self.version_ids(project):
+                self.archive(project, version_id)
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_body(self, status, body, headers):
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                chunk_size = 64 * 1024
+                for start in range(0, len(body), chunk_size):
+                    chunk = body[start:start + chunk_size]
+                    self.wfile.write(chunk)
+                    if fake.bandwidth:
+                        time.sleep(len(chunk) / fake.bandwidth)
+                with fake.lock:
+                    fake.bytes_sent += len(body)
+
+            def do_GET(self):
+                if self.path == "/_stats":
+                    with fake.lock:
+                        stats = {"requests": fake.requests, "bytes_sent": fake.bytes_sent}
+                    body = json.dumps(stats).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                with fake.lock:
+                    fake.requests += 1
+                    failed = fake.random.random() < fake.error_rate
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if failed:
+                    return self.send_body(500, b"", {})
+
+                if match := download_pattern.match(self.path):
+                    project = fake.projects.get(int(match.group(1)))
+                    version_id = int(match.group(2))
+                    if project is None or version_id not in fake.version_ids(project):
+                        return self.send_body(404, b"", {})
+                    body = fake.archive(project, version_id)
+                    etag = f'"{sha256(body).hexdigest()[:16]}"'
+                    headers = {"Content-Type": "application/zip", "ETag": etag}
+                    range_header = self.headers.get("Range")
+                    if range_header and self.headers.get("If-Range", etag) == etag:
+                        start = int(range_header.removeprefix("bytes=").split("-")[0])
+                        if start >= len(body):
+                            return self.send_body(416, b"", {"Content-Range": f"bytes */{len(body)}"})
+                        headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+                        return self.send_body(206, body[start:], headers)
+                    return self.send_body(200, body, headers)
+
+                if match := files_pattern.match(self.path):
+                    project = fake.projects.get(int(match.group(1)))
+                    if project is None:
+                        return self.send_body(404, b"", {})
+                    query = parse_qs(urlsplit(self.path).query)
+                    body = fake.listing(project, int(query.get("pageIndex", ["0"])[0]),
+                                        int(query.get("pageSize", ["50"])[0]))
+                    etag = f'"{sha256(body).hexdigest()[:16]}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        return self.send_body(304, b"", {"ETag": etag})
+                    return self.send_body(200, body, {"Content-Type": "application/json", "ETag": etag})
+
+                self.send_body(404, b"", {})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve CurseForge-like file listings and downloads from fixtures.")
+    parser.add_argument("--fixtures", default=str(fixtures_path))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per response")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--archive-files", type=int, default=None, help="override files per archive")
+    parser.add_argument("--file-size", type=int, default=None, help="override bytes per archived file")
+    parser.add_argument("--game-version", type=int, default=517)
+    args = parser.parse_args()
+
+    fake = FakeCurseForge(load_fixtures(args.fixtures), latency=args.latency, bandwidth=args.bandwidth,
+                          error_rate=args.error_rate, archive_files=args.archive_files, file_size=args.file_size,
+                          game_version=args.game_version).start()
+    # The first line of output tells the caller where to send requests.
+    print(fake.base_url, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+bench_dir = Path(__file__).parent
+repo_dir = bench_dir.parent
+
+# Loading the plugin must not pull in the network stack; the client imports it on first use.
+lazy_modules = ("requests", "urllib3", "charset_normalizer", "idna", "certifi")
+
+
+def measure_import(root):
+    """Import main.py under `python -X importtime` and return {module: (self_us, cumulative_us)}.
+
+    Only main and the modules it pulled in are returned; whatever the interpreter
+    imported at startup (site, .pth hooks) is left out.
+    """
+    for name in ("settings", "runtime", "logs"):
+        (root / name).mkdir(parents=True, exist_ok=True)
+    env = dict(os.environ,
+               DECKY_HOME=str(root),
+               DECKY_PLUGIN_SETTINGS_DIR=str(root / "settings"),
+               DECKY_PLUGIN_RUNTIME_DIR=str(root / "runtime"),
+               DECKY_PLUGIN_LOG_DIR=str(root / "logs"),
+               PYTHONPATH=os.pathsep.join([str(bench_dir), str(repo_dir / "py_modules"), str(repo_dir)]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"],
+                            env=env, cwd=root, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        if not name.startswith("  "):
+            # A top-level import; its dependencies were the lines printed just before it.
+            if name.strip() == "main":
+                modules["main"] = (int(self_us), int(cumulative_us))
+                return modules
+            modules = {}
+            continue
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    raise RuntimeError("main was not imported")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check how long importing main.py takes and what it pulls in.")
+    parser.add_argument("--budget-ms", type=float, default=150.0, help="maximum cumulative import time of main.py")
+    parser.add_argument("--runs", type=int, default=5, help="take the fastest of this many runs")
+    parser.add_argument("--top", type=int, default=10, help="show this many of the slowest imports")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="wow-addon-import-") as root:
+        runs = [measure_import(Path(root)) for _ in range(args.runs)]
+    modules = min(runs, key=lambda run: run["main"][1])
+
+    total_ms = modules["main"][1] / 1000
+    print(f"main.py imported in {total_ms:.1f} ms (budget {args.budget_ms:.1f} ms)")
+    for name, (self_us, cumulative_us) in sorted(modules.items(), key=lambda item: item[1][0], reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:>8.2f} ms self {cumulative_us / 1000:>8.2f} ms cumulative  {name}")
+
+    eager = sorted(name for name in modules if name.split(".")[0] in lazy_modules)
+    failures = []
+    if eager:
+        failures.append(f"network stack imported at load time: {', '.join(eager)}")
+    if total_ms > args.budget_ms:
+        failures.append(f"import took {total_ms:.1f} ms, over the {args.budget_ms:.1f} ms budget")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 import os
 import sqlite3
 from datetime import datetime
-from time import sleep
 import time
 
 # The decky plugin module is located at decky-loader/plugin
@@ -10,58 +9,259 @@ import time
 import decky
 import asyncio
 import json
+import random
+import shutil
+import tempfile
+import fcntl
 from pathlib import Path
 import zipfile
-import requests
+import hashlib
+import threading
+from types import MappingProxyType
+from collections import Counter
+from contextlib import aclosing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from curseforge_client import CurseForgeClient
+from perf_stats import perf
 
 
 
 db_path = Path(decky.DECKY_PLUGIN_SETTINGS_DIR) / "local_db.sqlite"
 
+
+class Database:
+    """Long-lived SQLite connection shared by every helper and thread.
+
+    The connection runs in WAL mode with synchronous=NORMAL and keeps its
+    prepared statements cached. Access is serialized with a lock, read()
+    serves queries and each cursor() block is an atomic write. cursor()
+    blocks nest: an inner block joins the outer one's transaction, so a
+    helper can group the writes of a whole run into a single commit. Never
+    hold a block open across an await or slow I/O, since every other thread
+    and coroutine waits on the lock meanwhile.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = None
+        self.closed = False
+        self.rollback_listeners = []
+
+    def connect(self):
+        with self.lock:
+            if self.closed:
+                raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                            cached_statements=256)
+                self.conn.execute("PRAGMA journal_mode=WAL;")
+                self.conn.execute("PRAGMA synchronous=NORMAL;")
+            return self.conn
+
+    @contextmanager
+    def cursor(self):
+        with self.lock:
+            conn = self.connect()
+            owns_transaction = not conn.in_transaction
+            if owns_transaction:
+                conn.execute("BEGIN;")
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            except BaseException:
+                if owns_transaction:
+                    conn.rollback()
+                    for listener in self.rollback_listeners:
+                        listener()
+                raise
+            else:
+                if owns_transaction:
+                    conn.commit()
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def read(self):
+        """Cursor for queries that don't write.
+
+        Runs in autocommit mode, or inside the enclosing cursor() block's
+        transaction, so reads never issue a commit of their own.
+        """
+        with self.lock:
+            cursor = self.connect().cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    def close(self):
+        """Close the connection for good; later use raises instead of reopening it."""
+        with self.lock:
+            self.closed = True
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+db = Database(db_path)
+
 config_path = Path(decky.DECKY_PLUGIN_SETTINGS_DIR) / "config.json"
 
-mode = 'r' if os.path.exists(config_path) else 'w+'
-with open(config_path, mode) as f:
-    if mode == 'r':
-        config = json.load(f)
-    else:
-        config = {
-            "game_version": 517,
-            "page_size": 3,
-            "target_dir": "<target_directory(ex ..._retail_/wtf/interface/addOns/)>",
-            "last_update_check": 0
+default_config = {
+    "game_version": 517,
+    "page_size": 3,
+    "history_page_size": 50,
+    "sync_max_pages": 100,
+    "check_workers": 8,
+    "download_workers": 4,
+    "extract_workers": 1,
+    "extract_threads": 4,
+    "cache_max_bytes": 536870912,
+    "perf_log": False,
+    "update_check_interval": 3600,
+    "update_check_jitter": 300,
+    "target_dir": "<target_directory(ex ..._retail_/wtf/interface/addOns/)>"
+}
+
+
+class ConfigFile:
+    """config.json, parsed once and re-read only when its mtime changes.
+
+    snapshot() returns a read-only mapping that is replaced as a whole on
+    reload, so a caller that takes one snapshot sees consistent values for
+    the rest of its work. The mtime is checked at most once per
+    reload_interval seconds.
+    """
+
+    def __init__(self, path, defaults, reload_interval=1.0):
+        self.path = path
+        self.defaults = defaults
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.checked_at = 0.0
+        if not os.path.exists(path):
+            self.write(defaults)
+        self.data = MappingProxyType(dict(defaults))
+        self.reload()
+
+    def write(self, data):
+        temporary_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temporary_path, 'w') as f:
+            json.dump(data, f, indent=4)
+        os.replace(temporary_path, self.path)
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            decky.logger.error(f"Failed to load {self.path}, keeping the previous config: {e}")
+            return
+        self.mtime = mtime
+        self.data = MappingProxyType({**self.defaults, **data})
+
+    def snapshot(self):
+        now = time.monotonic()
+        if now - self.checked_at >= self.reload_interval:
+            with self.lock:
+                if now - self.checked_at >= self.reload_interval:
+                    self.checked_at = now
+                    self.reload()
+        return self.data
+
+
+settings = ConfigFile(config_path, default_config)
+
+update_check_delay = 10
+update_check_retry_delay = 60
+# Files listed but not yet downloadable are looked at again on later syncs for this long.
+pending_file_max_age = 7 * 24 * 3600
+
+client = CurseForgeClient(pool_size=settings.snapshot()["check_workers"])
+
+cache_dir = Path(decky.DECKY_PLUGIN_RUNTIME_DIR) / 'cache'
+unpacked_dir = Path(decky.DECKY_PLUGIN_RUNTIME_DIR) / 'unpacked'
+download_chunk_size = 64 * 1024
+# Below this many members per thread an archive is unpacked with fewer threads.
+unpack_members_per_thread = 32
+# ioctl from linux/fs.h that makes a copy-on-write clone of a file (btrfs, xfs).
+FICLONE = 0x40049409
+# Reference counts of the archives installs are using or about to use, by SHA-256.
+archives_in_use = Counter()
+archives_in_use_lock = threading.Lock()
+# Staging and rollback copies live inside target_dir so swapping them in is a same-filesystem rename.
+install_work_dir_name = '.addon-updater'
+
+class WantedAddon:
+    __slots__ = ("name", "project_id", "desired_version", "date", "current_version_id")
+
+    def __init__(self, name, project_id, desired_version, date, current_version_id):
+        self.name = name
+        self.project_id = project_id
+        self.desired_version = desired_version
+        self.date = date
+        self.current_version_id = current_version_id
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "project_id": self.project_id,
+            "desired_version": self.desired_version,
+            "date": self.date,
+            "current_version_id": self.current_version_id
         }
-        json.dump(config, f, indent=4)
 
-base_url = "https://www.curseforge.com/api/v1/mods/"
-target_dir = config["target_dir"]
 
-def load_wanted_addons_from_sqlite():
-    """Load wanted addons from SQLite database."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM wanted_addons")
-    addons = cursor.fetchall()
-    addon_list = []
-    for addon in addons:
-        [name, project_id, desired_version, date, current_version_id] = addon
-        addon_list.append({
-            "name": name,
-            "project_id": project_id,
-            "desired_version": desired_version,
-            "date": date,
-            "current_version_id": current_version_id
-        })
+class AddonRegistry:
+    """In-memory copy of wanted_addons, reloaded lazily after every write.
+
+    Every function that writes wanted_addons calls invalidate(), so RPC reads
+    are served from memory without touching SQLite until something changes.
+    """
+
+    def __init__(self):
+        self.addons = None
+        self.generation = 0
+        self.lock = threading.Lock()
 
-    conn.close()
-    return addon_list
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.addons = None
 
-def parse_addon_data(project_id, file):
+    def get(self):
+        addons = self.addons
+        if addons is not None:
+            return addons
+        with self.lock:
+            generation = self.generation
+        with db.read() as cursor:
+            cursor.execute("SELECT name, project_id, desired_version, date, current_version_id FROM wanted_addons")
+            addons = tuple(WantedAddon(*row) for row in cursor.fetchall())
+        with self.lock:
+            # Don't cache rows read before a write that happened meanwhile.
+            if generation == self.generation:
+                self.addons = addons
+        return addons
+
+
+registry = AddonRegistry()
+db.rollback_listeners.append(registry.invalidate)
+
+def load_wanted_addons_from_sqlite():
+    """Load wanted addons, served from the in-memory registry."""
+    return [addon.to_dict() for addon in registry.get()]
+
+def parse_addon_data(project_id, file, game_version):
     try:
         gameVersions = file["gameVersions"]
         gameVersionTypeIds = file["gameVersionTypeIds"]
-        wanted_version_index = gameVersionTypeIds.index(config['game_version'])
+        wanted_version_index = gameVersionTypeIds.index(game_version)
     except ValueError:
         decky.logger.error(f"Value error while parsing addon data for project ID {project_id}.")
         return None
@@ -70,134 +270,997 @@ def parse_addon_data(project_id, file):
         "project_id": project_id,
         "file_name": file["fileName"],
         "date_created": file["dateCreated"],
-        "game_version": gameVersions[wanted_version_index]
+        "game_version": gameVersions[wanted_version_index],
+        "file_length": file.get("fileLength"),
+        # CurseForge lists hashes with algo 1 for SHA-1 and 2 for MD5.
+        "file_sha1": next((h["value"] for h in file.get("hashes", []) if h.get("algo") == 1), None)
     }
 
-def get_new_versions(project_id, current_version):
-    """Get new versions for the given project ID."""
-    decky.logger.info(f"Getting new versions for project ID {project_id}: {current_version}...")
+def get_http_validators(url):
+    """Return (etag, last_modified, body_sha256) stored for a URL, or None."""
+    with db.read() as cursor:
+        cursor.execute("SELECT etag, last_modified, body_sha256 FROM http_cache WHERE url =?;", (url,))
+        return cursor.fetchone()
 
-    # Load headers from headers.txt
-    headers = {}
-    try:
-        with open('headers.txt', 'r') as f:
-            for line in f:
-                if ':' in line:
-                    key, value = line.strip().split(':', 1)
-                    headers[key.strip()] = value.strip()
-    except OSError:
-        decky.logger.error("Failed to load headers from headers.txt")
 
-    url = f"{base_url}{project_id}/files"
+def get_sync_cursor(project_id, game_version):
+    """Return (version_id, date_created) of the newest file seen for a project's game_version listing, or None.
+
+    The listing is filtered by game flavor, so each flavor has its own cursor
+    and switching game_version starts a full walk of the new flavor.
+    """
+    with db.read() as cursor:
+        cursor.execute("SELECT version_id, date_created FROM sync_cursors WHERE project_id =? AND game_version =?;",
+                       (project_id, game_version))
+        return cursor.fetchone()
+
+def save_sync_states(sync_states):
+    """Store the (project_id, game_version, cursor, validators) states get_new_versions returned."""
+    with db.cursor() as cursor:
+        cursor.executemany("""
+            INSERT OR REPLACE INTO sync_cursors (project_id, game_version, version_id, date_created)
+            VALUES (?,?,?,?);
+        """, [(project_id, game_version, *newest) for project_id, game_version, newest, _ in sync_states if newest])
+        cursor.executemany("""
+            INSERT OR REPLACE INTO http_cache (url, etag, last_modified, body_sha256)
+            VALUES (?,?,?,?);
+        """, [validators for *_, validators in sync_states if validators])
+
+def is_pending_file(file):
+    """Whether a listed file is not downloadable yet but may become so (recent uploads under review)."""
+    if file["isAvailableForDownload"]:
+        return False
+    created = datetime.fromisoformat(file["dateCreated"].replace("Z", "+00:00"))
+    return time.time() - created.timestamp() < pending_file_max_age
+
+def get_files_page(project_id, query, conditional):
+    """Fetch one page of a project's "/files" listing.
+
+    With conditional set the stored validators of the first page are sent
+    back, and None is returned when the server reports 304 or the body is
+    byte-identical, so unchanged projects skip JSON decoding. Any other
+    status raises IOError, so a failed page is never mistaken for an
+    unchanged one.
+
+    Otherwise returns (data, validators). For the first page validators are
+    the (url, etag, last_modified, body_sha256) to store once the page has
+    been processed; for later pages they are None.
+    """
+    url = client.files_url(project_id, query)
     decky.logger.info(url)
-    # files?pageIndex=0&pageSize=20&sort=dateCreated&sortDescending=true&removeAlphas=true
-    query = {"pageIndex": 0, "pageSize": config['page_size'], "sort": "dateCreated", "sortAscending": True, "removeAlphas": True, "gameFlavorId": config['game_version']}
-    response = requests.get(url, headers=headers, params=query)
+    first_page = query["pageIndex"] == 0
+    validators = get_http_validators(url) if first_page and conditional else None
+    headers = {}
+    if validators:
+        etag, last_modified, _ = validators
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    response = client.get_files(project_id, query, headers=headers)
+    if response.status_code == 304:
+        return None
+    if response.status_code != 200:
+        raise IOError(f"Failed to get new versions for project ID {project_id}. Status code: {response.status_code}")
+    perf.add_bytes(len(response.content))
+    new_validators = None
+    if first_page:
+        body_sha256 = hashlib.sha256(response.content).hexdigest()
+        if validators and validators[2] == body_sha256:
+            return None
+        new_validators = (url, response.headers.get("ETag"), response.headers.get("Last-Modified"), body_sha256)
+    return response.json(), new_validators
+
+@perf.timed("get_new_versions")
+def get_new_versions(project_id, stop=None):
+    """Get the versions of a project released since the last sync.
+
+    Pages through the listing newest first and stops at the first file that
+    is already known from the project's sync cursor, so a routine check
+    fetches one small page while the first sync walks the whole history
+    with larger pages. To keep that walk in bounded memory, the first sync
+    stores each page's versions as soon as the page is parsed; they are
+    inserted with INSERT OR IGNORE, so walking the range again is harmless.
+
+    Returns (new_versions, sync_state). new_versions holds what a routine
+    sync found and is empty after a first sync. The cursor and the first
+    page's HTTP validators are never written here: the caller stores them
+    with save_sync_states together with the versions. If any
+    page fails or can't be parsed the error propagates, and the next sync
+    fetches and walks the same range again. A recent file that is
+    listed but not downloadable yet holds the cursor below it, so it is
+    returned by the sync after it becomes available. Setting the stop event
+    aborts the walk with InterruptedError before the next page is fetched.
+
+    Validators are stored per URL, and the routine page's URL differs from
+    the history pages' by pageSize. So a first sync fetches the routine page
+    once before its walk and keeps that page's validators: anything released
+    after that request changes the routine page, so the next check can't
+    mistake it for unchanged.
+    """
+    config = settings.snapshot()
+    sync_cursor = get_sync_cursor(project_id, config['game_version'])
+    decky.logger.info(f"Getting new versions for project ID {project_id} since {sync_cursor}...")
+    page_size = config['page_size'] if sync_cursor else config['history_page_size']
+
+    def files_query(page_index, page_size):
+        # files?pageIndex=0&pageSize=20&sort=dateCreated&sortDescending=true&removeAlphas=true
+        return {"pageIndex": page_index, "pageSize": page_size, "sort": "dateCreated", "sortDescending": True, "removeAlphas": True, "gameFlavorId": config['game_version']}
+
     results = []
-    if response.status_code == 200:
-        data = response.json()
-        decky.logger.info(f"Found {data['data']} new versions for project ID {project_id}.")
-        for file in data["data"]:
+    found = 0
+    newest = None
+    validators = None
+    if sync_cursor is None:
+        _, validators = get_files_page(project_id, files_query(0, config['page_size']), conditional=False)
+    for page_index in range(config['sync_max_pages']):
+        if stop is not None and stop.is_set():
+            raise InterruptedError(f"Update check of project ID {project_id} was cancelled")
+        page = get_files_page(project_id, files_query(page_index, page_size), conditional=sync_cursor is not None)
+        if page is None:
+            break
+        data, page_validators = page
+        if sync_cursor is not None:
+            validators = validators or page_validators
+        files = data["data"]
+        reached_known = False
+        for file in files:
+            if sync_cursor and file["id"] <= sync_cursor[0] and file["dateCreated"] <= sync_cursor[1]:
+                reached_known = True
+                break
+            if is_pending_file(file):
+                # Everything seen so far is newer; only older files may move the cursor.
+                newest = None
+                continue
+            if newest is None or file["id"] > newest[0]:
+                newest = (file["id"], file["dateCreated"])
             if not file["isAvailableForDownload"]: continue
-            if not current_version or file["id"] > current_version:
-                addon_data = parse_addon_data(project_id, file)
-                if addon_data:
-                    results.append(addon_data)
-    else:
-        decky.logger.error(f"Failed to get new versions for project ID {project_id}. Status code: {response.status_code}")
-
-    return results
-
-def get_latest_versions(wanted_addons):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    query = """
-    SELECT av.*
-    FROM addon_versions av
-    INNER JOIN (
-        SELECT project_id, MAX(version_id) as max_version_id
-        FROM addon_versions
-        GROUP BY project_id
-    ) latest
-    ON av.project_id = latest.project_id AND av.version_id = latest.max_version_id
+            addon_data = parse_addon_data(project_id, file, config['game_version'])
+            if addon_data:
+                results.append(addon_data)
+                found += 1
+        if sync_cursor is None and results:
+            add_versions_to_db(results)
+            results = []
+        total_count = data.get("pagination", {}).get("totalCount")
+        if reached_known or len(files) < page_size or (total_count is not None and (page_index + 1) * page_size >= total_count):
+            break
+
+    decky.logger.info(f"Found {found} new versions for project ID {project_id}.")
+    if newest == sync_cursor:
+        newest = None
+    return results, (project_id, config['game_version'], newest, validators)
+
+async def check_wanted_addons(wanted_addons):
+    """Query the "/files" listing of every wanted addon with bounded concurrency.
+
+    Yields (addon, new_versions, sync_state) in completion order, so the
+    caller can report progress while the slower requests are still running.
+    new_versions and sync_state are None when the addon's check raised.
+    When the caller stops iterating, queued listings are dropped and the
+    walks in flight end after their current page; the generator returns
+    only once no worker thread is left.
     """
+    if not wanted_addons:
+        return
+    loop = asyncio.get_running_loop()
+    client.reload_headers()
+    workers = max(1, min(settings.snapshot()["check_workers"], len(wanted_addons)))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="update-check")
+    stop = threading.Event()
 
-    cursor.execute(query)
-    rows = cursor.fetchall()
+    async def check(addon):
+        try:
+            return addon, *await loop.run_in_executor(executor, get_new_versions, addon["project_id"], stop)
+        except Exception as e:
+            decky.logger.error(f"Failed to check project ID {addon['project_id']}: {e}")
+            return addon, None, None
+
+    tasks = [asyncio.ensure_future(check(addon)) for addon in wanted_addons]
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        # A cancelled check must not block the loop until every queued listing has been fetched.
+        stop.set()
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Wait off the loop for the walks in flight, even if the caller is cancelled again meanwhile.
+        drained = asyncio.ensure_future(asyncio.to_thread(executor.shutdown))
+        cancelled = False
+        while not drained.done():
+            try:
+                await asyncio.shield(drained)
+            except asyncio.CancelledError:
+                cancelled = True
+        if cancelled:
+            raise asyncio.CancelledError
+
+@perf.timed("get_latest_versions")
+def get_latest_versions():
+    """Return the newest known version of every wanted addon that is behind it.
+
+    The newest row per project is found with an index seek on
+    (project_id, version_id), so the lookup stays flat as history grows.
+    """
+    with db.read() as cursor:
+        cursor.execute("""
+            SELECT av.project_id, av.version_id, av.file_name, av.game_version, av.date_created
+            FROM wanted_addons wa
+            INNER JOIN addon_versions av
+            ON av.version_id = (
+                SELECT MAX(version_id)
+                FROM addon_versions
+                WHERE project_id = wa.project_id
+            )
+            WHERE wa.current_version_id IS NULL OR av.version_id > wa.current_version_id;
+        """)
+        rows = cursor.fetchall()
 
     latest_versions = []
     for row in rows:
-        addon_description = {
+        latest_versions.append({
             "version_id": row[1],
             "project_id": row[0],
             "file_name": row[2],
             "date_created": row[4],
             "game_version": row[3]
-        }
-        for wanted_addon in wanted_addons:
-            if addon_description["project_id"] == wanted_addon["project_id"]:
-                if wanted_addon["current_version_id"] is None:
-                    latest_versions.append(addon_description)
-                    break
-                if addon_description["version_id"] > wanted_addon["current_version_id"]:
-                    latest_versions.append(addon_description)
-                    break
-    conn.close()
+        })
     return latest_versions
 
+@perf.timed("add_versions_to_db")
 def add_versions_to_db(new_versions):
-    """Add new versions to SQLite database."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    """Add new versions of any number of projects to SQLite in one transaction.
 
-    for version in new_versions:
-        cursor.execute("""
-            INSERT OR ignore INTO addon_versions (version_id, project_id, file_name, date_created, game_version)  
-            VALUES (?,?,?,?,?);
-        """, (version["version_id"], version["project_id"], version["file_name"], version["date_created"], version["game_version"]))
+    Returns (inserted, ignored), the number of rows that were new and the
+    number that were already known.
+    """
+    with db.cursor() as cursor:
+        cursor.executemany("""
+            INSERT OR ignore INTO addon_versions (version_id, project_id, file_name, date_created, game_version, file_length, file_sha1)
+            VALUES (?,?,?,?,?,?,?);
+        """, [(version["version_id"], version["project_id"], version["file_name"], version["date_created"], version["game_version"],
+               version.get("file_length"), version.get("file_sha1"))
+              for version in new_versions])
+        inserted = max(cursor.rowcount, 0)
+    return inserted, len(new_versions) - inserted
+
+def store_check_results(found_versions, sync_states):
+    """Store everything a check run found in one short transaction.
 
-    conn.commit()
-    conn.close()
+    The new versions, sync cursors, listing validators and the time of the
+    check are committed together, so a failed run leaves no partial state
+    that would make the next check skip what this one missed.
+    """
+    with db.cursor():
+        inserted, ignored = add_versions_to_db(found_versions)
+        save_sync_states(sync_states)
+        save_last_update_check(time.time())
+    return inserted, ignored
 
 def update_addon_version_in_db(version_id, project_id):
     """Update the current version ID in the database."""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        UPDATE wanted_addons
-        SET current_version_id =?, date = CURRENT_TIMESTAMP
-        WHERE project_id =?;
-    """, (version_id, project_id))
-    decky.logger.info(f"Updated current version ID for project ID {project_id} to {version_id}.")
-    conn.commit()
-    conn.close()
+    with db.cursor() as cursor:
+        cursor.execute("""
+            UPDATE wanted_addons
+            SET current_version_id =?, date = CURRENT_TIMESTAMP
+            WHERE project_id =?;
+        """, (version_id, project_id))
+        decky.logger.info(f"Updated current version ID for project ID {project_id} to {version_id}.")
+    registry.invalidate()
+
+def update_addon_versions_in_db(versions):
+    """Update the current version ID of several addons in one transaction."""
+    with db.cursor() as cursor:
+        cursor.executemany("""
+            UPDATE wanted_addons
+            SET current_version_id =?, date = CURRENT_TIMESTAMP
+            WHERE project_id =?;
+        """, [(version["version_id"], version["project_id"]) for version in versions])
+        decky.logger.info(f"Updated current version ID for {len(versions)} addons.")
+    registry.invalidate()
+
+def load_partial_download(partial_path, download_url):
+    """Return the sidecar metadata of a partial download that can be resumed, or None."""
+    meta_path = partial_path.with_name(partial_path.name + '.json')
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != download_url or not partial_path.exists():
+        return None
+    return meta
 
+def discard_partial_download(partial_path):
+    partial_path.unlink(missing_ok=True)
+    partial_path.with_name(partial_path.name + '.json').unlink(missing_ok=True)
+
+def get_cached_archive(project_id, version_id):
+    """Return the cached archive of a version and mark it as recently used, or None on a miss.
+
+    The lookup is a plain read; only a hit (or a stale row) opens a write.
+    """
+    with db.read() as cursor:
+        cursor.execute("SELECT sha256 FROM download_cache WHERE project_id =? AND version_id =?;", (project_id, version_id))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    path = cache_dir / 'objects' / f"{row[0]}.zip"
+    with db.cursor() as cursor:
+        if path.exists():
+            cursor.execute("""
+                UPDATE download_cache SET last_used = ? WHERE project_id =? AND version_id =?;
+            """, (time.time(), project_id, version_id))
+            return path
+        cursor.execute("DELETE FROM download_cache WHERE project_id =? AND version_id =?;", (project_id, version_id))
+    return None
+
+def add_archive_to_cache(addon_description, partial_path, sha256):
+    """Move a finished download into the content-addressed store and index it."""
+    path = cache_dir / 'objects' / f"{sha256}.zip"
+    path.parent.mkdir(exist_ok=True, parents=True)
+    if path.exists():
+        # Identical archive already cached under another version or name.
+        partial_path.unlink()
+    else:
+        os.replace(partial_path, path)
+
+    with db.cursor() as cursor:
+        # Keep the unpacked size if another version already unpacked the same archive.
+        cursor.execute("""
+            INSERT OR REPLACE INTO download_cache (project_id, version_id, sha256, size, file_name, last_used, unpacked_size)
+            VALUES (?,?,?,?,?,?,(SELECT COALESCE(MAX(unpacked_size), 0) FROM download_cache WHERE sha256 =?));
+        """, (addon_description["project_id"], addon_description["version_id"], sha256, path.stat().st_size,
+              addon_description["file_name"], time.time(), sha256))
+    return path
+
+def pin_archive(sha256):
+    with archives_in_use_lock:
+        archives_in_use[sha256] += 1
+
+def unpin_archive(sha256):
+    with archives_in_use_lock:
+        archives_in_use[sha256] -= 1
+        if not archives_in_use[sha256]:
+            del archives_in_use[sha256]
+
+@contextmanager
+def archive_pinned(sha256):
+    pin_archive(sha256)
+    try:
+        yield
+    finally:
+        unpin_archive(sha256)
+
+def set_unpacked_size(sha256, size):
+    with db.cursor() as cursor:
+        cursor.execute("UPDATE download_cache SET unpacked_size = ? WHERE sha256 =?;", (size, sha256))
+
+def prune_unpacked_store():
+    """Delete unpacked directories no cached archive accounts for, such as leftovers of an interrupted unpack."""
+    if not unpacked_dir.is_dir():
+        return
+    with db.read() as cursor:
+        cursor.execute("SELECT DISTINCT sha256 FROM download_cache;")
+        known = {row[0] for row in cursor.fetchall()}
+    with archives_in_use_lock:
+        for entry in unpacked_dir.iterdir():
+            if entry.name not in known:
+                shutil.rmtree(entry, ignore_errors=True)
+
+def evict_cache():
+    """Delete least recently used archives until the cache fits in cache_max_bytes.
+
+    The budget covers both the archive and its directory in the unpacked
+    store, which is a full copy wherever target_dir is on another
+    filesystem and installs fall back to copying.
+
+    Archives pinned by a running install, or queued for one, are skipped.
+    Called once after an upgrade run rather than after every download.
+    """
+    max_bytes = settings.snapshot()["cache_max_bytes"]
+    with db.read() as cursor:
+        cursor.execute("""
+            SELECT sha256, MAX(size) + MAX(unpacked_size), MAX(last_used) AS used
+            FROM download_cache
+            GROUP BY sha256
+            ORDER BY used;
+        """)
+        archives = cursor.fetchall()
+    total = sum(size for _, size, _ in archives)
+    evicted = []
+    # Held while deleting so no install can pin an archive that is being removed.
+    with archives_in_use_lock:
+        for sha256, size, _ in archives:
+            if total <= max_bytes:
+                break
+            if sha256 in archives_in_use:
+                continue
+            (cache_dir / 'objects' / f"{sha256}.zip").unlink(missing_ok=True)
+            shutil.rmtree(unpacked_dir / sha256, ignore_errors=True)
+            evicted.append((sha256,))
+            total -= size
+            decky.logger.info(f"Evicted cached archive {sha256}")
+    with db.cursor() as cursor:
+        cursor.executemany("DELETE FROM download_cache WHERE sha256 =?;", evicted)
+
+def get_file_metadata(version_id):
+    """Return the (file_length, file_sha1) the "/files" listing advertised for a version; either may be None."""
+    with db.read() as cursor:
+        cursor.execute("SELECT file_length, file_sha1 FROM addon_versions WHERE version_id =?;", (version_id,))
+        row = cursor.fetchone()
+    return row if row else (None, None)
+
+def verify_archive(path, size):
+    """Check that a downloaded archive's central directory parses and only points inside the file.
+
+    ZipFile reads just the end of central directory record and the directory
+    itself, so this costs a small read from the tail, not a pass over the
+    file. Member CRCs are checked when the archive is unpacked.
+    """
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.header_offset + info.compress_size > size:
+                raise zipfile.BadZipFile(f"{info.filename} extends past the end of the archive")
+            if info.filename.startswith('/') or '..' in Path(info.filename).parts:
+                raise zipfile.BadZipFile(f"{info.filename} points outside the target directory")
+
+@perf.timed("download_new_version")
 def download_new_version(addon_description):
-    decky.logger.info(f"Downloading new version for project ID {addon_description['project_id']} version ID {addon_description['version_id']}...")
-    download_url = f'https://www.curseforge.com/api/v1/mods/{addon_description["project_id"]}/files/{addon_description["version_id"]}/download'
+    """Make sure the archive of a version is in the cache and return its path."""
+    project_id = addon_description["project_id"]
+    version_id = addon_description["version_id"]
+    cached = get_cached_archive(project_id, version_id)
+    if cached:
+        decky.logger.info(f"Using cached archive for project ID {project_id} version ID {version_id}")
+        return cached
+
+    decky.logger.info(f"Downloading new version for project ID {project_id} version ID {version_id}...")
+    download_url = client.download_url(project_id, version_id)
     decky.logger.info(f"Download URL: {download_url}")
-    decky.logger.info(download_url)
-    response = requests.get(download_url)
-    data = response.content
-    download_dir = Path(decky.DECKY_PLUGIN_RUNTIME_DIR) / 'cache' / addon_description['file_name']
+    download_dir = cache_dir / addon_description['file_name']
     decky.logger.info(download_dir)
     download_dir.parent.mkdir(exist_ok=True, parents=True)
-    download_dir.write_bytes(data)
+    # Stream into a partial file and move it into the cache once complete,
+    # so only one chunk is held in memory and a cut-off download never looks finished.
+    # The partial file and its sidecar are kept on failure so the next attempt can resume.
+    partial_path = download_dir.with_name(download_dir.name + '.part')
+    meta = load_partial_download(partial_path, download_url)
+    offset = partial_path.stat().st_size if meta else 0
+    headers = {"Accept-Encoding": "identity"}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        validator = meta.get("etag") or meta.get("last_modified")
+        if validator:
+            headers["If-Range"] = validator
+
+    response = client.download(project_id, version_id, stream=True, headers=headers)
+    if response.status_code == 416:
+        response.close()
+        decky.logger.info(f"Server rejected resume of {partial_path.name}, starting over")
+        discard_partial_download(partial_path)
+        offset = 0
+        del headers["Range"]
+        headers.pop("If-Range", None)
+        response = client.download(project_id, version_id, stream=True, headers=headers)
+
+    file_length, file_sha1 = get_file_metadata(version_id)
+    digest = hashlib.sha256()
+    sha1 = hashlib.sha1() if file_sha1 else None
+    with response:
+        response.raise_for_status()
+        if offset and response.status_code == 206 and response.headers.get("Content-Range", "").startswith(f"bytes {offset}-"):
+            decky.logger.info(f"Resuming {partial_path.name} at byte {offset}")
+            mode = 'ab'
+            with open(partial_path, 'rb') as f:
+                while chunk := f.read(download_chunk_size):
+                    digest.update(chunk)
+                    if sha1:
+                        sha1.update(chunk)
+        else:
+            offset = 0
+            mode = 'wb'
+            content_length = response.headers.get("Content-Length")
+            meta = {
+                "url": download_url,
+                "length": int(content_length) if content_length else None,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            with open(partial_path.with_name(partial_path.name + '.json'), 'w') as f:
+                json.dump(meta, f)
+        with open(partial_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=download_chunk_size):
+                digest.update(chunk)
+                if sha1:
+                    sha1.update(chunk)
+                f.write(chunk)
+                perf.add_bytes(len(chunk))
+
+    # Everything is checked against digests computed while streaming, so a bad
+    # download is rejected before it enters the cache and without reading it again.
+    size = partial_path.stat().st_size
+    problem = None
+    if meta["length"] is not None and size != meta["length"]:
+        problem = f"has {size} bytes, expected {meta['length']}"
+    elif file_length is not None and size != file_length:
+        problem = f"has {size} bytes, the listing says {file_length}"
+    elif sha1 and sha1.hexdigest() != file_sha1.lower():
+        problem = f"has SHA-1 {sha1.hexdigest()}, the listing says {file_sha1}"
+    else:
+        try:
+            verify_archive(partial_path, size)
+        except zipfile.BadZipFile as e:
+            problem = f"is not a valid zip archive: {e}"
+    if problem:
+        discard_partial_download(partial_path)
+        raise IOError(f"Download of {download_dir.name} {problem}")
+    sha256 = digest.hexdigest()
+    archive = add_archive_to_cache(addon_description, partial_path, sha256)
+    partial_path.with_name(partial_path.name + '.json').unlink(missing_ok=True)
+    return archive
+
+def load_installed_files(project_id, root):
+    """Return {path: (size, crc32, mtime)} of the files installed for an addon under root."""
+    with db.read() as cursor:
+        cursor.execute("SELECT path, size, crc32, mtime FROM installed_files WHERE project_id =? AND root =?;",
+                       (project_id, str(root)))
+        manifest = {path: (size, crc32, mtime) for path, size, crc32, mtime in cursor.fetchall()}
+    return manifest
+
+def save_installed_files(project_id, version_id, root, files):
+    """Replace the manifest of an addon under root with (path, size, crc32, mtime) rows."""
+    with db.cursor() as cursor:
+        cursor.execute("DELETE FROM installed_files WHERE project_id =? AND root =?;", (project_id, str(root)))
+        cursor.executemany("""
+            INSERT INTO installed_files (project_id, version_id, root, path, size, crc32, mtime)
+            VALUES (?,?,?,?,?,?,?);
+        """, [(project_id, version_id, str(root), path, size, crc32, mtime) for path, size, crc32, mtime in files])
+
+def get_shared_files(project_id, paths, root):
+    """Return the subset of paths under root that another addon's manifest also owns."""
+    with db.read() as cursor:
+        shared = set()
+        for path in paths:
+            cursor.execute("SELECT 1 FROM installed_files WHERE root =? AND path =? AND project_id !=? LIMIT 1;",
+                           (str(root), path, project_id))
+            if cursor.fetchone():
+                shared.add(path)
+    return shared
+
+def remove_installed_files(project_id, paths, root):
+    """Delete files an addon no longer ships from root, plus directories left empty by that."""
+    paths = set(paths) - get_shared_files(project_id, paths, root)
+    parents = set()
+    for path in paths:
+        file_path = root / path
+        file_path.unlink(missing_ok=True)
+        parents.update(file_path.parents)
+    for directory in sorted(parents, key=lambda p: len(p.parts), reverse=True):
+        if directory == root or root not in directory.parents:
+            continue
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+    return len(paths)
+
+def link_or_copy(source, destination):
+    """Hardlink source to destination, or reflink or else copy it where the filesystem refuses links."""
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+        return
+    except OSError:
+        pass
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            shutil.copyfileobj(src, dst, download_chunk_size)
+        os.fsync(dst.fileno())
+    shutil.copystat(source, destination)
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def swap_in_staged(root, staging, rollback, names):
+    """Rename each staged top-level entry into root, moving the one it replaces to rollback.
+
+    Either every entry is swapped in or, if a rename fails, the ones already
+    swapped are put back and the error is re-raised.
+    """
+    moved = []
+    try:
+        for name in names:
+            live = root / name
+            replaced = os.path.lexists(live)
+            if replaced:
+                os.rename(live, rollback / name)
+            moved.append((name, replaced))
+            os.rename(staging / name, live)
+    except OSError:
+        for name, replaced in reversed(moved):
+            if not os.path.lexists(staging / name):
+                os.rename(root / name, staging / name)
+            if replaced:
+                os.rename(rollback / name, root / name)
+        raise
+
+def recover_staged_installs():
+    """Undo swaps a crash interrupted and drop leftover staging directories."""
+    work_dir = Path(settings.snapshot()["target_dir"]) / install_work_dir_name
+    root = work_dir.parent
+    rollback_dir = work_dir / 'rollback'
+    if rollback_dir.is_dir():
+        for journal in rollback_dir.glob('*.swapping'):
+            rollback = journal.with_suffix('')
+            if rollback.is_dir():
+                for entry in rollback.iterdir():
+                    if not os.path.lexists(root / entry.name):
+                        os.rename(entry, root / entry.name)
+                        decky.logger.info(f"Restored {entry.name} after an interrupted install")
+            journal.unlink()
+    shutil.rmtree(work_dir / 'staging', ignore_errors=True)
+
+def unpack_members(archive, infos, destination):
+    """Decompress the given members into destination, whose directories already exist.
+
+    Runs in an unpack thread with its own ZipFile handle; zlib and the CRC32
+    check release the GIL, so several of these run in parallel.
+    """
+    with zipfile.ZipFile(archive, 'r') as zip_ref:
+        for info in infos:
+            with zip_ref.open(info) as src, open(destination / info.filename, 'wb') as dst:
+                shutil.copyfileobj(src, dst, download_chunk_size)
+                os.fsync(dst.fileno())
+
+def get_installed_unpacked(project_id, root):
+    """Return the unpacked store directory of the version installed under root, or None if it is gone."""
+    with db.read() as cursor:
+        cursor.execute("""
+            SELECT dc.sha256
+            FROM installed_files inf
+            INNER JOIN download_cache dc ON dc.project_id = inf.project_id AND dc.version_id = inf.version_id
+            WHERE inf.project_id =? AND inf.root =?
+            LIMIT 1;
+        """, (project_id, str(root)))
+        row = cursor.fetchone()
+    if row and (unpacked_dir / row[0]).is_dir():
+        return unpacked_dir / row[0]
+    return None
+
+def find_reusable_members(infos, manifest, root, previous):
+    """Map the members whose size and CRC32 match the installed manifest to an existing copy.
+
+    The previous version's unpacked store directory is preferred since it is
+    never modified; otherwise the live copy is used if it is unmodified on disk.
+    """
+    reusable = {}
+    for info in infos:
+        installed = manifest.get(info.filename)
+        if not installed or installed[:2] != (info.file_size, info.CRC):
+            continue
+        for source, mtime in ((previous and previous / info.filename, None), (root / info.filename, installed[2])):
+            if source is None:
+                continue
+            try:
+                stat = source.stat()
+            except OSError:
+                continue
+            if stat.st_size == info.file_size and mtime in (None, stat.st_mtime):
+                reusable[info.filename] = source
+                break
+    return reusable
+
+def unpack_archive(archive, reusable=None):
+    """Return the directory holding the members of a cached archive, unpacking it on first use.
+
+    Directories are named after the archive's SHA-256 like the cache objects,
+    so a version is unpacked once however often, and into however many
+    target_dirs, it is installed. Installs hardlink these files, so they must
+    never be modified in place. The unpacked size is recorded in
+    download_cache so evict_cache counts it against cache_max_bytes.
+
+    Members listed in reusable, a {filename: path} map of files known to
+    hold the same bytes (see find_reusable_members), are linked instead of
+    decompressed, so a small update writes only the members that changed.
+    The directory tree is created up front and the remaining members are
+    spread over up to extract_threads threads, largest first, so archives
+    with thousands of files decompress on every core.
+    """
+    path = unpacked_dir / archive.stem
+    if path.is_dir():
+        return path
+    unpacked_dir.mkdir(parents=True, exist_ok=True)
+    temporary_path = Path(tempfile.mkdtemp(prefix=archive.stem + '.', dir=unpacked_dir))
+    try:
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+        for info in infos:
+            if info.filename.startswith('/') or '..' in Path(info.filename).parts:
+                raise ValueError(f"Refusing to extract {info.filename} outside the target directory")
+        for directory in {Path(info.filename).parent for info in infos}:
+            (temporary_path / directory).mkdir(parents=True, exist_ok=True)
+
+        changed = []
+        for info in infos:
+            source = (reusable or {}).get(info.filename)
+            try:
+                if source is None:
+                    raise FileNotFoundError(info.filename)
+                link_or_copy(source, temporary_path / info.filename)
+            except OSError:
+                changed.append(info)
+        changed.sort(key=lambda info: info.compress_size, reverse=True)
+        threads = max(1, min(settings.snapshot()["extract_threads"], len(changed) // unpack_members_per_thread))
+        if threads == 1:
+            unpack_members(archive, changed, temporary_path)
+        else:
+            with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="unpack") as executor:
+                # Striping the size-sorted list gives every thread a similar share of bytes.
+                for _ in executor.map(unpack_members, [archive] * threads,
+                                      [changed[i::threads] for i in range(threads)], [temporary_path] * threads):
+                    pass
+        unpacked_size = sum(info.file_size for info in infos)
+        perf.add_bytes(sum(info.file_size for info in changed))
+        decky.logger.info(f"Unpacked {len(changed)} of {len(infos)} members of {archive.name}, linked the rest")
+
+        for directory, _, _ in os.walk(temporary_path, topdown=False):
+            fsync_path(directory)
+        os.rename(temporary_path, path)
+    except OSError:
+        # Another extractor may have unpacked the same archive first.
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        if not path.is_dir():
+            raise
+    except BaseException:
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        raise
+    else:
+        set_unpacked_size(archive.stem, unpacked_size)
+    return path
+
+def stage_version(infos, unpacked, root, staging, manifest):
+    """Assemble the files of a version under staging.
+
+    Members whose size and CRC32 match the installed file manifest (and are
+    unmodified on disk) are linked from the live copy, the rest from the
+    unpacked store. Returns the (path, size, crc32, mtime) rows of the
+    version and the number of members that changed.
+    """
+    files = []
+    written = 0
+    for info in infos:
+        file_path = root / info.filename
+        staged_path = staging / info.filename
+        installed = manifest.get(info.filename)
+        if installed and installed[:2] == (info.file_size, info.CRC):
+            try:
+                stat = file_path.stat()
+                if stat.st_size == info.file_size and stat.st_mtime == installed[2]:
+                    link_or_copy(file_path, staged_path)
+                    files.append((info.filename, info.file_size, info.CRC, installed[2]))
+                    continue
+            except OSError:
+                pass
+        link_or_copy(unpacked / info.filename, staged_path)
+        written += 1
+        files.append((info.filename, info.file_size, info.CRC, staged_path.stat().st_mtime))
+    return files, written
+
+@perf.timed("extract_file")
 def extract_file(version):
-    """Extract the downloaded version to a directory."""
-    download_dir = Path(decky.DECKY_PLUGIN_RUNTIME_DIR) / 'cache' / version['file_name']
-    decky.logger.info(f"Extracting new version for project ID {version['project_id']} version ID {version['version_id']}..." + download_dir.name)
+    """Install the downloaded version into target_dir without touching the live folders until it is complete.
+
+    The archive is unpacked once into the unpacked store, and the addon's
+    top-level folders are assembled from links to it in a staging directory
+    next to the live ones, then each is renamed into place. The folders they replace
+    are kept under the rollback directory until the addon's next install, and
+    a journal file lets recover_staged_installs undo a swap a crash cut short.
+    Files another addon owns, or that no manifest knows, are carried over from
+    the live folders; files the new version no longer ships are dropped.
+    """
+    project_id = version['project_id']
+    download_dir = get_cached_archive(project_id, version['version_id']) or download_new_version(version)
+    with archive_pinned(download_dir.stem):
+        if not download_dir.exists():
+            # Evicted between the lookup and the pin.
+            download_dir = download_new_version(version)
+        decky.logger.info(f"Extracting new version for project ID {project_id} version ID {version['version_id']}..." + download_dir.name)
+        with zipfile.ZipFile(download_dir, 'r') as zip_ref:
+            infos = [info for info in zip_ref.infolist() if not info.is_dir()]
+
+        root = Path(settings.snapshot()["target_dir"])
+        work_dir = root / install_work_dir_name
+        staging = work_dir / 'staging' / str(project_id)
+        rollback = work_dir / 'rollback' / str(project_id)
+        manifest = load_installed_files(project_id, root)
+        previous = get_installed_unpacked(project_id, root)
+        unpacked = unpack_archive(download_dir, find_reusable_members(infos, manifest, root, previous))
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        try:
+            files, written = stage_version(infos, unpacked, root, staging, manifest)
+            names = {Path(path).parts[0] for path, *_ in files}
+            shipped = {path for path, *_ in files}
+            dropped = manifest.keys() - shipped
+            shared = get_shared_files(project_id, dropped, root)
+            for name in names:
+                if not (root / name).is_dir():
+                    continue
+                for directory, _, file_names in os.walk(root / name):
+                    for file_name in file_names:
+                        path = Path(directory, file_name).relative_to(root).as_posix()
+                        if path not in shipped and (path not in manifest or path in shared):
+                            link_or_copy(root / path, staging / path)
+            for directory, _, _ in os.walk(staging, topdown=False):
+                fsync_path(directory)
+
+            shutil.rmtree(rollback, ignore_errors=True)
+            rollback.mkdir(parents=True)
+            journal = rollback.with_name(rollback.name + '.swapping')
+            journal.touch()
+            fsync_path(rollback.parent)
+            swap_in_staged(root, staging, rollback, sorted(names))
+            fsync_path(root)
+            journal.unlink()
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        removed = len({path for path in dropped if Path(path).parts[0] in names} - shared)
+        removed += remove_installed_files(project_id, {path for path in dropped if Path(path).parts[0] not in names}, root)
+        save_installed_files(project_id, version['version_id'], root, files)
+        decky.logger.info(f"Wrote {written} of {len(files)} files, removed {removed} for project ID {project_id}")
+
+def delete_installed_files(project_id):
+    with db.cursor() as cursor:
+        cursor.execute("DELETE FROM installed_files WHERE project_id =?;", (project_id,))
+
+@perf.timed("uninstall_addon_files")
+def uninstall_addon_files(project_id):
+    """Delete every file the addon's manifests list, then the manifests and the addon's rollback copies.
+
+    Each manifest row records the target_dir it was installed into, so an
+    addon installed into several trees is removed from all of them, not from
+    whatever target_dir is configured now. Only the manifest is consulted, so
+    the work is proportional to the addon's file count. Files another addon's
+    manifest also lists under the same root are left in place.
+    """
+    with db.read() as cursor:
+        cursor.execute("SELECT DISTINCT root FROM installed_files WHERE project_id =?;", (project_id,))
+        roots = [Path(row[0]) for row in cursor.fetchall()]
+    removed = 0
+    for root in roots:
+        removed += remove_installed_files(project_id, load_installed_files(project_id, root).keys(), root)
+        shutil.rmtree(root / install_work_dir_name / 'rollback' / str(project_id), ignore_errors=True)
+    delete_installed_files(project_id)
+    decky.logger.info(f"Removed {removed} files for project ID {project_id}")
+    return removed
+
+def cleanup_installed_files():
+    """Uninstall the files of addons that have a manifest but are no longer wanted."""
+    with db.read() as cursor:
+        cursor.execute("""
+            SELECT DISTINCT project_id FROM installed_files
+            WHERE project_id NOT IN (SELECT project_id FROM wanted_addons);
+        """)
+        orphans = [row[0] for row in cursor.fetchall()]
+    for project_id in orphans:
+        uninstall_addon_files(project_id)
+    return len(orphans)
+
+async def upgrade_versions(versions):
+    """Download, extract and commit the given versions as a pipeline.
+
+    download_workers downloaders feed a bounded queue that extract_workers
+    extractors drain, so the network and the disk are busy at the same time.
+    A single committer writes finished upgrades to wanted_addons in batches.
+    Emits upgrade_progress(stage, done, total) for the "download", "extract"
+    and "commit" stages. Returns (upgraded, failed): the versions that were
+    installed and those whose download or extraction failed.
+    """
+    total = len(versions)
+    if not total:
+        return [], []
+    config = settings.snapshot()
+    download_workers = max(1, min(config["download_workers"], total))
+    extract_workers = max(1, config["extract_workers"])
+    download_queue = asyncio.Queue()
+    for version in versions:
+        download_queue.put_nowait(version)
+    extract_queue = asyncio.Queue(maxsize=extract_workers * 2)
+    commit_queue = asyncio.Queue()
+    done = {"download": 0, "extract": 0, "commit": 0}
+    upgraded = []
+    failed = []
+
+    async def report(stage):
+        done[stage] += 1
+        await decky.emit("upgrade_progress", stage, done[stage], total)
 
-    zip_ref = zipfile.ZipFile(download_dir, 'r')
-    zip_ref.extractall(config["target_dir"])
-    zip_ref.close()
+    async def downloader():
+        while not download_queue.empty():
+            version = download_queue.get_nowait()
+            try:
+                archive = await asyncio.to_thread(download_new_version, version)
+            except Exception as e:
+                decky.logger.error(f"Failed to download project ID {version['project_id']}: {e}")
+                failed.append(version)
+                continue
+            # Pinned until extracted, so eviction never removes an archive waiting in the queue.
+            pin_archive(archive.stem)
+            await report("download")
+            await extract_queue.put((version, archive))
 
+    async def extractor():
+        while (item := await extract_queue.get()) is not None:
+            version, archive = item
+            try:
+                await asyncio.to_thread(extract_file, version)
+            except Exception as e:
+                decky.logger.error(f"Failed to extract project ID {version['project_id']}: {e}")
+                failed.append(version)
+                continue
+            finally:
+                unpin_archive(archive.stem)
+            await report("extract")
+            await commit_queue.put(version)
+
+    async def committer():
+        finished = False
+        while not finished:
+            batch = [await commit_queue.get()]
+            while not commit_queue.empty():
+                batch.append(commit_queue.get_nowait())
+            if None in batch:
+                batch.remove(None)
+                finished = True
+            if batch:
+                await asyncio.to_thread(update_addon_versions_in_db, batch)
+                upgraded.extend(batch)
+                for _ in batch:
+                    await report("commit")
+
+    committer_task = asyncio.create_task(committer())
+    extractors = [asyncio.create_task(extractor()) for _ in range(extract_workers)]
+    try:
+        await asyncio.gather(*(downloader() for _ in range(download_workers)))
+        for _ in extractors:
+            await extract_queue.put(None)
+        await asyncio.gather(*extractors)
+        await commit_queue.put(None)
+        await committer_task
+    finally:
+        for task in extractors + [committer_task]:
+            task.cancel()
+        while not extract_queue.empty():
+            if (item := extract_queue.get_nowait()) is not None:
+                unpin_archive(item[1].stem)
+    await asyncio.to_thread(evict_cache)
+    return upgraded, failed
+
+def raise_for_failed_upgrades(failed, total):
+    """Raise so the frontend learns that some of the requested upgrades didn't happen."""
+    if failed:
+        project_ids = ", ".join(str(version["project_id"]) for version in failed)
+        raise RuntimeError(f"Failed to upgrade {len(failed)} of {total} addons (project IDs {project_ids})")
+
+
+def add_missing_columns(cursor, table, columns):
+    cursor.execute(f"PRAGMA table_info({table});")
+    existing = {row[1] for row in cursor.fetchall()}
+    for column, definition in columns:
+        if column not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition};")
 
 def create_db_if_not_exists():
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
     wanted_addons_table = """
 CREATE TABLE if not exists "wanted_addons"
     (
@@ -221,29 +1284,120 @@ CREATE TABLE if not exists "addon_versions"
             primary key,
     file_name    text,
     game_version text,
-    date_created date
+    date_created date,
+    file_length  integer default null,
+    file_sha1    text    default null
 );
 """
-    cursor.execute(wanted_addons_table)
-    cursor.execute(addon_versions_table)
-
-    conn.commit()
-    conn.close()
+    download_cache_table = """
+CREATE TABLE if not exists "download_cache"
+(
+    project_id   integer not null,
+    version_id   integer not null,
+    sha256       text    not null,
+    size         integer not null,
+    file_name    text,
+    last_used    real    not null,
+    unpacked_size integer default 0,
+    constraint download_cache_pk
+        primary key (project_id, version_id)
+);
+"""
+    installed_files_table = """
+CREATE TABLE if not exists "installed_files"
+(
+    project_id   integer not null,
+    version_id   integer not null,
+    root         text    not null,
+    path         text    not null,
+    size         integer not null,
+    crc32        integer not null,
+    mtime        real    not null,
+    constraint installed_files_pk
+        primary key (project_id, root, path)
+);
+"""
+    http_cache_table = """
+CREATE TABLE if not exists "http_cache"
+(
+    url          text    not null
+        constraint http_cache_pk
+            primary key,
+    etag         text,
+    last_modified text,
+    body_sha256  text
+);
+"""
+    plugin_state_table = """
+CREATE TABLE if not exists "plugin_state"
+(
+    key          text    not null
+        constraint plugin_state_pk
+            primary key,
+    value
+);
+"""
+    sync_cursors_table = """
+CREATE TABLE if not exists "sync_cursors"
+(
+    project_id   integer not null,
+    game_version integer not null,
+    version_id   integer not null,
+    date_created date    not null,
+    constraint sync_cursors_pk
+        primary key (project_id, game_version)
+);
+"""
+    with db.cursor() as cursor:
+        cursor.execute(wanted_addons_table)
+        cursor.execute(addon_versions_table)
+        cursor.execute(download_cache_table)
+        cursor.execute(installed_files_table)
+        cursor.execute(http_cache_table)
+        cursor.execute(plugin_state_table)
+        cursor.execute(sync_cursors_table)
+        # Databases created by older versions lack these columns.
+        add_missing_columns(cursor, "addon_versions", (("file_length", "integer default null"), ("file_sha1", "text default null")))
+        add_missing_columns(cursor, "download_cache", (("unpacked_size", "integer default 0"),))
+        cursor.execute("PRAGMA table_info(installed_files);")
+        if "root" not in {row[1] for row in cursor.fetchall()}:
+            # The manifest used to be keyed without the target_dir; those rows belong to the current one.
+            cursor.execute("ALTER TABLE installed_files RENAME TO installed_files_old;")
+            cursor.execute(installed_files_table)
+            cursor.execute("""
+                INSERT INTO installed_files (project_id, version_id, root, path, size, crc32, mtime)
+                SELECT project_id, version_id, ?, path, size, crc32, mtime FROM installed_files_old;
+            """, (str(Path(settings.snapshot()["target_dir"])),))
+            cursor.execute("DROP TABLE installed_files_old;")
+        cursor.execute("PRAGMA table_info(sync_cursors);")
+        if "game_version" not in {row[1] for row in cursor.fetchall()}:
+            # Cursors used to be kept per project only; they were walked with the current game_version.
+            cursor.execute("ALTER TABLE sync_cursors RENAME TO sync_cursors_old;")
+            cursor.execute(sync_cursors_table)
+            cursor.execute("""
+                INSERT INTO sync_cursors (project_id, game_version, version_id, date_created)
+                SELECT project_id, ?, version_id, date_created FROM sync_cursors_old;
+            """, (settings.snapshot()["game_version"],))
+            cursor.execute("DROP TABLE sync_cursors_old;")
+        cursor.execute("CREATE INDEX if not exists addon_versions_project_id_version_id_index ON addon_versions (project_id, version_id);")
+        cursor.execute("CREATE INDEX if not exists installed_files_root_path_index ON installed_files (root, path);")
+        cursor.execute("CREATE INDEX if not exists download_cache_sha256_index ON download_cache (sha256);")
 
 def add_addon_to_db(project_id, name):
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT INTO wanted_addons (project_id, name)
-        VALUES (?,?);
-    """, (project_id, name))
-
-    conn.commit()
-    conn.close()
+    with db.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO wanted_addons (project_id, name)
+            VALUES (?,?);
+        """, (project_id, name))
+    registry.invalidate()
     decky.logger.info(f"Added addon with project ID {project_id} and name '{name}' to the database.")
 
 
+def remove_addon_from_db(project_id):
+    with db.cursor() as cursor:
+        cursor.execute("DELETE FROM wanted_addons WHERE project_id =?;", (project_id,))
+    registry.invalidate()
+
 def add_essentials():
     add_addon_to_db(914482, "Baganator")
     add_addon_to_db(91376, "ConsolePort")
@@ -293,99 +1447,196 @@ def add_addons():
     add_addon_to_db(86372, "Mount Journal Enhanced")
     add_addon_to_db(29767, "FarmHud")
     add_addon_to_db(30801, "Rarity")
+def get_last_update_check():
+    with db.read() as cursor:
+        cursor.execute("SELECT value FROM plugin_state WHERE key = 'last_update_check';")
+        row = cursor.fetchone()
+    # Older versions kept last_update_check in config.json.
+    return row[0] if row else settings.snapshot().get("last_update_check", 0)
+
+def save_last_update_check(checked_at):
+    with db.cursor() as cursor:
+        cursor.execute("""
+            INSERT OR REPLACE INTO plugin_state (key, value)
+            VALUES ('last_update_check', ?);
+        """, (checked_at,))
+
+def update_check_due():
+    """Whether the last finished check is older than update_check_interval."""
+    return time.time() - get_last_update_check() >= settings.snapshot()["update_check_interval"]
+
 def init_plugin():
+    if settings.snapshot()["perf_log"]:
+        perf.set_log_path(Path(decky.DECKY_PLUGIN_LOG_DIR) / "perf.jsonl")
     create_db_if_not_exists()
+    recover_staged_installs()
+    prune_unpacked_store()
+    cleanup_installed_files()
     return load_wanted_addons_from_sqlite()
 
 
 
 class Plugin:
+    update_check_task = None
+    scheduler_task = None
 
-    async def check_for_updates(self):
-        sleep(10)
-        config = json.load(open(config_path, 'r'))
-        last_update_check = config.get("last_update_check", 0)
-        if (time.time() - last_update_check) < 3600:
-            return []
-
-        config["last_update_check"] = time.time()
-        json.dump(config, open(config_path, 'w'), indent=4)
-        wanted_addons = load_wanted_addons_from_sqlite()
-
-        for addon in wanted_addons:
-            project_id = addon["project_id"]
-            current_version = addon["current_version_id"]
-            new_versions = get_new_versions(project_id, current_version)
-            add_versions_to_db(new_versions)
-        latest_versions = get_latest_versions(wanted_addons)
-        if latest_versions:
-            await decky.emit("new_versions_found", len(latest_versions))
-            return latest_versions
-        return []
+    async def _run_update_check(self):
+        """Check every wanted addon once and store what was found.
 
-    async def manual_check_for_updates(self):
-        decky.logger.info("Manually checking for updates...")
-        wanted_addons = load_wanted_addons_from_sqlite()
+        Returns the latest versions and the number of projects whose check failed.
+        """
+        wanted_addons = await asyncio.to_thread(load_wanted_addons_from_sqlite)
         total = len(wanted_addons)
         await decky.emit("update_progress", 0, total)
         progress = 0
-        for addon in wanted_addons:
-            await decky.emit("update_progress", progress, total)
-            progress += 1
-            project_id = addon["project_id"]
-            current_version = addon["current_version_id"]
-            new_versions = get_new_versions(project_id, current_version)
-            add_versions_to_db(new_versions)
-        latest_versions = get_latest_versions(wanted_addons)
-        await decky.emit("new_versions_found", len(latest_versions))
-        await decky.emit("update_progress", -1)
+        failed = 0
+        found_versions = []
+        sync_states = []
+        try:
+            # aclosing stops the worker threads even when the cancellation lands outside the generator.
+            async with aclosing(check_wanted_addons(wanted_addons)) as checks:
+                async for addon, new_versions, sync_state in checks:
+                    if new_versions is None:
+                        failed += 1
+                    else:
+                        found_versions.extend(new_versions)
+                        sync_states.append(sync_state)
+                    progress += 1
+                    await decky.emit("update_progress", progress, total)
+            inserted, ignored = await asyncio.to_thread(store_check_results, found_versions, sync_states)
+        finally:
+            await decky.emit("update_progress", -1)
+        decky.logger.info(f"Stored {inserted} new versions, {ignored} already known")
+        if failed:
+            decky.logger.error(f"Failed to check {failed} of {total} projects")
+        latest_versions = await asyncio.to_thread(get_latest_versions)
         if latest_versions:
             decky.logger.info(f"Versions found: {len(latest_versions)}")
-            return latest_versions
-        decky.logger.info(f"No versions found...")
-        return []
+            await decky.emit("new_versions_found", len(latest_versions))
+        return latest_versions, failed
+
+    def _start_update_check(self):
+        """Return the check in flight, starting one only if none is running.
+
+        The scheduler, resume and manual triggers all await this task, so
+        triggers arriving together share one scan instead of starting several.
+        """
+        if self.update_check_task is None or self.update_check_task.done():
+            self.update_check_task = asyncio.create_task(self._run_update_check())
+        return self.update_check_task
+
+    async def _join_update_check(self):
+        """Await the shared check and return its latest versions.
+
+        The check is shielded, so a caller going away doesn't cancel it for
+        everyone else. If the shared check itself was cancelled, e.g. by
+        _unload, this returns []; a cancellation of the caller propagates.
+        """
+        task = self._start_update_check()
+        try:
+            latest_versions, _ = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled() and not asyncio.current_task().cancelling():
+                return []
+            raise
+        return latest_versions
+
+    async def _schedule_update_checks(self):
+        """Check for updates every update_check_interval seconds plus random jitter.
+
+        After a run with failed projects the next one comes sooner, backing off
+        exponentially from update_check_retry_delay up to the regular interval.
+        """
+        await asyncio.sleep(update_check_delay)
+        failures = 0
+        while True:
+            config = settings.snapshot()
+            if failures:
+                delay = min(update_check_retry_delay * 2 ** (failures - 1), config["update_check_interval"])
+            else:
+                last_update_check = await asyncio.to_thread(get_last_update_check)
+                delay = max(0.0, last_update_check + config["update_check_interval"] - time.time())
+            await asyncio.sleep(delay + random.uniform(0, config["update_check_jitter"]))
+            # A manual or resume check may have run while we slept.
+            if not failures and not await asyncio.to_thread(update_check_due):
+                continue
+            try:
+                _, failed = await asyncio.shield(self._start_update_check())
+            except Exception as e:
+                decky.logger.error(f"Scheduled update check failed: {e}")
+                failed = 1
+            failures = failures + 1 if failed else 0
+
+    async def check_for_updates(self):
+        # Called on panel render and resume: joins a running check, starts one if the
+        # last is older than the interval, and otherwise answers from the database.
+        if (self.update_check_task is None or self.update_check_task.done()) \
+                and not await asyncio.to_thread(update_check_due):
+            return await asyncio.to_thread(get_latest_versions)
+        return await self._join_update_check()
+
+    async def manual_check_for_updates(self):
+        decky.logger.info("Manually checking for updates...")
+        latest_versions = await self._join_update_check()
+        if not latest_versions:
+            decky.logger.info(f"No versions found...")
+            await decky.emit("new_versions_found", 0)
+        return latest_versions
 
     async def get_versions_from_config(self):
         return decky.DECKY_PLUGIN_VERSION
 
     async def upgrade_addon(self, version):
-        download_new_version(version)
-        extract_file(version)
-        update_addon_version_in_db(version["version_id"], version["project_id"])
-        return load_wanted_addons_from_sqlite()
+        # Same pipeline as upgrade_all, so the download and install run off the event loop.
+        _, failed = await upgrade_versions([version])
+        raise_for_failed_upgrades(failed, 1)
+        return await asyncio.to_thread(load_wanted_addons_from_sqlite)
 
     async def upgrade_all(self):
-        latest_versions = get_latest_versions(load_wanted_addons_from_sqlite())
-        for version in latest_versions:
-            download_new_version(version)
-            extract_file(version)
-            update_addon_version_in_db(version["version_id"], version["project_id"])
-        return load_wanted_addons_from_sqlite()
+        latest_versions = await asyncio.to_thread(get_latest_versions)
+        _, failed = await upgrade_versions(latest_versions)
+        raise_for_failed_upgrades(failed, len(latest_versions))
+        return await asyncio.to_thread(load_wanted_addons_from_sqlite)
 
 
 
+    async def get_perf_stats(self):
+        return perf.snapshot()
+
     async def list_addons(self):
         # Return a list of addons and their details
-        return load_wanted_addons_from_sqlite()
+        return await asyncio.to_thread(load_wanted_addons_from_sqlite)
     async def get_addons_with_updates(self):
-        wanted_addons = load_wanted_addons_from_sqlite()
-        return get_latest_versions(wanted_addons)
+        return await asyncio.to_thread(get_latest_versions)
+
+    async def uninstall_addon(self, project_id):
+        await asyncio.to_thread(uninstall_addon_files, project_id)
+        await asyncio.to_thread(remove_addon_from_db, project_id)
+        return await asyncio.to_thread(load_wanted_addons_from_sqlite)
 
     async def install_essentials(self):
-        add_essentials()
-        return load_wanted_addons_from_sqlite()
+        await asyncio.to_thread(add_essentials)
+        return await asyncio.to_thread(load_wanted_addons_from_sqlite)
 
 
 
     # Asyncio-compatible long-running code, executed in a task when the plugin is loaded
     async def _main(self):
         init_plugin()
-        #self.loop = asyncio.get_event_loop()
+        self.scheduler_task = asyncio.create_task(self._schedule_update_checks())
 
     # Function called first during the unload process, utilize this to handle your plugin being stopped, but not
     # completely removed
     async def _unload(self):
-        pass
+        tasks = [task for task in (self.scheduler_task, self.update_check_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        # A cancelled check stops its listing threads before returning; wait for that so
+        # nothing still uses the client or the database once they are closed.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        client.close()
+        await asyncio.to_thread(db.close)
+        perf.close()
 
     # Function called after `_unload` during uninstall, utilize this to clean up processes and other remnants of your
     # plugin that may remain on the system
@@ -412,3 +1663,6 @@ class Plugin:
         decky.migrate_runtime(
             os.path.join(decky.DECKY_HOME, "template"),
             os.path.join(decky.DECKY_USER_HOME, ".local", "share", "decky-template"))
+        # Request headers used to be read from headers.txt in the plugin directory;
+        # the client now loads them from DECKY_PLUGIN_SETTINGS_DIR next to config.json.
+        decky.migrate_settings(os.path.join(decky.DECKY_PLUGIN_DIR, "headers.txt"))
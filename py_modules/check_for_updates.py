@@ -4,8 +4,8 @@ import json
 from pathlib import Path
 
 import zipfile
-import requests
 from decky import DECKY_PLUGIN_SETTINGS_DIR
+from curseforge_client import CurseForgeClient
 
 db_path = Path(DECKY_PLUGIN_SETTINGS_DIR) / "local_db.sqlite"
 
@@ -23,9 +23,10 @@ with open(config_path, mode) as f:
         }
         json.dump(config, f, indent=4)
 
-base_url = "https://www.curseforge.com/api/v1/mods/"
 target_dir = config["target_dir"]
 
+client = CurseForgeClient()
+
 
 def load_wanted_addons_from_sqlite():
     """Load wanted addons from SQLite database."""
@@ -52,19 +53,10 @@ def get_new_versions(project_id, current_version):
     """Get new versions for the given project ID."""
     print(f"Getting new versions for project ID {project_id}...")
 
-    # Load headers from headers.txt
-    headers = {}
-    with open('headers.txt', 'r') as f:
-        for line in f:
-            if ':' in line:
-                key, value = line.strip().split(':', 1)
-                headers[key.strip()] = value.strip()
-
-    url = f"{base_url}{project_id}/files"
-    print(url)
+    print(client.files_url(project_id))
     # files?pageIndex=0&pageSize=20&sort=dateCreated&sortDescending=true&removeAlphas=true
     query = {"pageIndex": 0, "pageSize": config['page_size'], "sort": "dateCreated", "sortAscending": True, "removeAlphas": True}
-    response = requests.get(url, headers=headers, params=query)
+    response = client.get_files(project_id, query)
     results = []
     if response.status_code == 200:
         data = response.json()
@@ -139,9 +131,8 @@ def get_latest_versions(wanted_addons):
     return latest_versions
 
 def download_new_version(addon_description):
-    download_url = f'https://www.curseforge.com/api/v1/mods/{addon_description["project_id"]}/files/{addon_description["version_id"]}/download'
-    print(download_url)
-    response = requests.get(download_url)
+    print(client.download_url(addon_description["project_id"], addon_description["version_id"]))
+    response = client.download(addon_description["project_id"], addon_description["version_id"])
     data = response.content
     path = f"cache/{addon_description['file_name']}"
     with open(path, 'wb') as f:
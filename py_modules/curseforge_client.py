@@ -0,0 +1,108 @@
+import os
+import threading
+from pathlib import Path
+from urllib.parse import urlencode
+
+import decky
+
+base_url = "https://www.curseforge.com/api/v1/mods/"
+
+headers_path = Path(decky.DECKY_PLUGIN_SETTINGS_DIR) / "headers.txt"
+
+
+def load_headers(path):
+    """Load "Key: Value" request headers from a text file."""
+    headers = {}
+    with open(path, 'r') as f:
+        for line in f:
+            if ':' in line:
+                key, value = line.strip().split(':', 1)
+                headers[key.strip()] = value.strip()
+    return headers
+
+
+class CurseForgeClient:
+    """Plugin-wide HTTP client for all CurseForge traffic.
+
+    Every request goes through one requests.Session with a sized connection
+    pool, so a full check plus upgrade_all reuses a handful of keep-alive
+    connections instead of doing a TLS handshake per addon. requests and the
+    rest of the network stack are only imported when the first request is
+    made, so loading the plugin doesn't pay for them.
+    """
+
+    def __init__(self, pool_size=8, timeout=(10, 60), headers_path=headers_path):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.session_lock = threading.Lock()
+        self._session = None
+        self.headers_path = headers_path
+        self.headers_mtime = -1
+        self.file_headers = {}
+        self.reload_headers()
+
+    def reload_headers(self):
+        """Re-read the headers file into the session if its mtime changed since the last load.
+
+        Meant to be called once per check run, so individual requests never touch the file.
+        """
+        try:
+            mtime = os.stat(self.headers_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.headers_mtime:
+            return
+        self.headers_mtime = mtime
+        if self._session is not None:
+            for key in self.file_headers:
+                self._session.headers.pop(key, None)
+        self.file_headers = {}
+        if mtime is None:
+            decky.logger.error(f"Failed to load headers from {self.headers_path}")
+            return
+        try:
+            self.file_headers = load_headers(self.headers_path)
+        except OSError:
+            decky.logger.error(f"Failed to load headers from {self.headers_path}")
+        if self._session is not None:
+            self._session.headers.update(self.file_headers)
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self.session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update(self.file_headers)
+                    self._session = session
+        return self._session
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+    def files_url(self, project_id, params=None):
+        url = f"{base_url}{project_id}/files"
+        return f"{url}?{urlencode(params)}" if params else url
+
+    def download_url(self, project_id, version_id):
+        return f"{base_url}{project_id}/files/{version_id}/download"
+
+    def get_files(self, project_id, params, headers=None):
+        """GET the "/files" listing of a project."""
+        return self.get(self.files_url(project_id, params), headers=headers)
+
+    def download(self, project_id, version_id, **kwargs):
+        """GET the archive of a single file version."""
+        return self.get(self.download_url(project_id, version_id), **kwargs)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
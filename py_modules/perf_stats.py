@@ -0,0 +1,101 @@
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds in milliseconds of the latency histogram buckets; the last bucket is open-ended.
+bucket_bounds_ms = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+
+
+class Span:
+    __slots__ = ("name", "bytes")
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+
+
+class PerfStats:
+    """Per-operation latency histograms and byte counts for the plugin's hot paths.
+
+    Every finished span updates a cumulative histogram for its name and is kept
+    in a ring buffer of recent calls. With a log path set, each call is also
+    appended to that file as a JSON line.
+    """
+
+    def __init__(self, capacity=512):
+        self.recent = deque(maxlen=capacity)
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.log_file = None
+
+    def set_log_path(self, path):
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+            self.log_file = open(path, 'a', buffering=1) if path else None
+
+    def record(self, name, seconds, nbytes=0):
+        duration_ms = seconds * 1000
+        bucket = next((i for i, bound in enumerate(bucket_bounds_ms) if duration_ms <= bound), len(bucket_bounds_ms))
+        sample = {"name": name, "time": time.time(), "duration_ms": round(duration_ms, 3), "bytes": nbytes}
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = {
+                    "count": 0, "total_ms": 0.0, "max_ms": 0.0, "bytes": 0,
+                    "buckets": [0] * (len(bucket_bounds_ms) + 1)
+                }
+            histogram["count"] += 1
+            histogram["total_ms"] += duration_ms
+            histogram["max_ms"] = max(histogram["max_ms"], duration_ms)
+            histogram["bytes"] += nbytes
+            histogram["buckets"][bucket] += 1
+            self.recent.append(sample)
+            if self.log_file is not None:
+                self.log_file.write(json.dumps(sample) + "\n")
+
+    @contextmanager
+    def span(self, name):
+        stack = self.local.__dict__.setdefault("stack", [])
+        span = Span(name)
+        stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            stack.pop()
+            self.record(name, time.perf_counter() - start, span.bytes)
+
+    def timed(self, name):
+        """Decorator that wraps every call of a function in a span."""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_bytes(self, nbytes):
+        """Add to the byte count of the innermost span of the calling thread."""
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1].bytes += nbytes
+
+    def snapshot(self):
+        with self.lock:
+            operations = {}
+            for name, histogram in self.histograms.items():
+                operations[name] = dict(histogram, buckets=list(histogram["buckets"]),
+                                        mean_ms=histogram["total_ms"] / histogram["count"])
+            return {"bucket_bounds_ms": list(bucket_bounds_ms), "operations": operations, "recent": list(self.recent)}
+
+    def close(self):
+        self.set_log_path(None)
+
+
+perf = PerfStats()
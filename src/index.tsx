@@ -44,6 +44,7 @@ const get_version = callable<[], string>("get_versions_from_config");
 
 const list_addons = callable<[], IAddonInfo[]>("list_addons");
 const upgrade_addon_remote = callable<[IAddonVersionInfo], IAddonInfo[]>("upgrade_addon");
+const uninstall_addon_remote = callable<[number], IAddonInfo[]>("uninstall_addon");
 
 const check_for_updates = callable<[], IAddonVersionInfo[]>("check_for_updates");
 const manual_check_for_updates = callable<[], IAddonVersionInfo[]>("manual_check_for_updates");
@@ -79,10 +80,14 @@ function Content() {
             }
             setInProgress({...inProgress, progress, total});
         })
+        const upgrade_listener = addEventListener<[stage: string, done: number, total: number]>("upgrade_progress", (stage, done, total) => {
+            setInProgress({name: "Update All (" + stage + ")", inProgress: true, progress: done, total});
+        })
         return () => {
 
             // This is the cleanup function
             removeEventListener("update_progress", progress_listener);
+            removeEventListener("upgrade_progress", upgrade_listener);
 
             // It will be called when the component is unmounted
 
@@ -95,8 +100,24 @@ function Content() {
 
 
 
+    const upgrade_failed = async (error: unknown) => {
+        toaster.toast({
+            title: "Upgrade failed", body: String(error),
+        });
+        setAddonList(await list_addons());
+    }
+
     const upgrade_addon = async (version: IAddonVersionInfo) => {
-        const result = await upgrade_addon_remote(version);
+        try {
+            const result = await upgrade_addon_remote(version);
+            setAddonList(result);
+        } catch (error) {
+            await upgrade_failed(error);
+        }
+    }
+
+    const uninstall_addon = async (project_id: number) => {
+        const result = await uninstall_addon_remote(project_id);
         setAddonList(result);
     }
 
@@ -124,6 +145,7 @@ function Content() {
                         get_updates(info, versions)
                     }
                 </ul>
+                <ButtonItem layout="below" onClick={() => uninstall_addon(info.project_id)}>Uninstall</ButtonItem>
             </div>
         )
             ;
@@ -150,8 +172,15 @@ function Content() {
         setAddonList(result);
     };
     const updateAll = async () => {
-        const result = await update_all();
-        setAddonList(result);
+        setInProgress({ name: "Update All", inProgress: true, progress: 0, total: 0 });
+        try {
+            const result = await update_all();
+            setAddonList(result);
+        } catch (error) {
+            await upgrade_failed(error);
+        } finally {
+            stop_progress();
+        }
     };
 
 